@@ -32,13 +32,16 @@ Any container that shows the same behavior will do, this is purely an example of
 Happy programming!
 """
 import json
-from glob import glob
+import math
+import numpy as np
+import orjson
+import re
 import SimpleITK
 import random
 from multiprocessing import Pool
 from statistics import mean
 from pathlib import Path
-from pprint import pformat, pprint
+from pprint import pprint
 import os
 from picai_eval import evaluate
 from picai_eval.data_utils import sterilize
@@ -47,9 +50,14 @@ from picai_eval.data_utils import sterilize
 INPUT_DIRECTORY = Path("/input")
 OUTPUT_DIRECTORY = Path("/output")
 GROUND_TRUTH_DIRECTORY = Path("ground_truth")
+_JSON_NUMBER = re.compile(rb"-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?")
+VERBOSE = bool(os.environ.get("PANORAMA_DEBUG"))
+# Each picai_eval worker holds several full CT volumes, so keep the default small
+MAX_DEFAULT_EVAL_WORKERS = 4
 
 def main():
-    print_inputs()
+    if VERBOSE:
+        print_inputs()
 
     metrics = {}
     predictions = read_predictions()
@@ -63,67 +71,39 @@ def main():
 
 
 def panorama_process(predictions):
-    case_pred = {}
-    pred_paths = []
-    gt_paths = []
-    subject_list = []
+    if not predictions:
+        raise RuntimeError("No predictions found!")
 
-    for job in predictions:
+    # Collecting the files of each job is independent, so overlap the disk I/O
+    chunksize = 4
+    processes = max(1, min(available_cpus(), math.ceil(len(predictions) / chunksize)))
+    with Pool(processes=processes) as pool:
+        results = pool.map(_collect_one_job, predictions, chunksize=chunksize)
 
-        location_pdac_likelihood = get_file_location(
-            job_pk=job["pk"],
-            values=job["outputs"],
-            slug="pdac-likelihood",
-        )
-
-        location_pdac_detection_map = get_file_location(
-                job_pk=job["pk"],
-                values=job["outputs"],
-                slug="pdac-detection-map",
-        )
-        pdac_detection_map_file = glob(str(location_pdac_detection_map / "*.mha"))[0]
-
-        image_name_venous_phase_ct_scan = get_image_name(
-            values=job["inputs"],
-            slug="venous-phase-ct-scan",
-        )
-
-        result_pdac_likelihood = load_json_file(location=location_pdac_likelihood)
-
-        subject_id = image_name_venous_phase_ct_scan.split('_0000.nii.gz')[0]
-
-        ground_trut_path = str(GROUND_TRUTH_DIRECTORY / (subject_id + '.nii.gz'))
-
-        print('subject_id', subject_id)
-        print('location_pdac_likelihood', location_pdac_likelihood)
-        print('result_pdac_likelihood', result_pdac_likelihood)
-        print('location_pdac_detection_map', pdac_detection_map_file)
-
-
-        gt_paths += [ground_trut_path]
-        pred_paths += [pdac_detection_map_file]
-        subject_list += [subject_id]
-        case_pred[subject_id] = result_pdac_likelihood
+    gt_paths, pred_paths, subject_list, likelihoods = map(list, zip(*results))
+    case_pred = dict(zip(subject_list, likelihoods))
 
     print('Performing evaluation')
-    print('pred_paths', pred_paths)
-    print('gt_paths', gt_paths)
-    print('subject_list', subject_list)
+    if VERBOSE:
+        print('pred_paths', pred_paths)
+        print('gt_paths', gt_paths)
+        print('subject_list', subject_list)
 
     # perform evaluation
     metrics = evaluate(
         y_det=pred_paths,
         y_true=gt_paths,
         subject_list=subject_list,
-        y_true_postprocess_func=lambda lbl: (lbl == 1).astype(int),
-        num_parallel_calls = 1,
+        y_true_postprocess_func=lambda lbl: (lbl == 1).astype(np.uint8),
+        num_parallel_calls = get_eval_workers(),
         verbose= 1
     )
     print('Computing Metrics')
     # overwrite default case-level prediction derivation with user-defined one
     metrics.case_pred = case_pred
     print('Metrics done')
-    print(metrics.case_pred)
+    if VERBOSE:
+        print(metrics.case_pred)
 
     # store metrics (and add to_dict() conversion to metrics)
     metrics.to_dict = lambda: sterilize(metrics.minimal_dict())
@@ -143,9 +123,77 @@ def panorama_process(predictions):
     return aggregate_results
 
 
+def available_cpus():
+    # CPUs this process may run on, which inside a container can be fewer than the host has
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def get_eval_workers():
+    # Number of cases picai_eval evaluates in parallel, PANORAMA_EVAL_WORKERS overrides it
+    value = os.environ.get("PANORAMA_EVAL_WORKERS")
+    if value is None:
+        return max(1, min(MAX_DEFAULT_EVAL_WORKERS, available_cpus()))
+
+    try:
+        workers = int(value)
+    except ValueError:
+        workers = 0
+    if workers < 1:
+        raise RuntimeError(
+            f"PANORAMA_EVAL_WORKERS must be a positive integer, got {value!r}!"
+        )
+
+    return workers
+
+
+def _collect_one_job(job):
+    # Gathers the ground truth, detection map and likelihood of a single job
+    inputs_by_slug = index_by_slug(job["inputs"])
+    outputs_by_slug = index_by_slug(job["outputs"])
+
+    location_pdac_likelihood = get_file_location(
+        job_pk=job["pk"],
+        values_by_slug=outputs_by_slug,
+        slug="pdac-likelihood",
+    )
+
+    location_pdac_detection_map = get_file_location(
+            job_pk=job["pk"],
+            values_by_slug=outputs_by_slug,
+            slug="pdac-detection-map",
+    )
+    pdac_detection_map_file = str(_find_one(location_pdac_detection_map, suffixes=(".mha",)))
+
+    image_name_venous_phase_ct_scan = get_image_name(
+        values_by_slug=inputs_by_slug,
+        slug="venous-phase-ct-scan",
+    )
+
+    result_pdac_likelihood = _load_likelihood(location_pdac_likelihood)
+
+    subject_id = image_name_venous_phase_ct_scan.removesuffix('_0000.nii.gz')
+
+    ground_trut_path = str(GROUND_TRUTH_DIRECTORY / (subject_id + '.nii.gz'))
+
+    if VERBOSE:
+        print('subject_id', subject_id)
+        print('location_pdac_likelihood', location_pdac_likelihood)
+        print('result_pdac_likelihood', result_pdac_likelihood)
+        print('location_pdac_detection_map', pdac_detection_map_file)
+
+    return ground_trut_path, pdac_detection_map_file, subject_id, result_pdac_likelihood
+
+
 def print_inputs():
     # Just for convenience, in the logs you can then see what files you have to work with
-    input_files = [str(x) for x in Path(INPUT_DIRECTORY).rglob("*") if x.is_file()]
+    input_files = [
+        os.path.join(root, name)
+        for root, _, files in os.walk(INPUT_DIRECTORY)
+        for name in files
+    ]
 
     print("Input Files:")
     pprint(input_files)
@@ -158,49 +206,101 @@ def read_predictions():
         return json.loads(f.read())
 
 
-def get_image_name(*, values, slug):
-    # This tells us the user-provided name of the input or output image
+def index_by_slug(values):
+    # Maps the interface slug of each input or output to its value, the first one wins
+    values_by_slug = {}
     for value in values:
-        if value["interface"]["slug"] == slug:
-            return value["image"]["name"]
+        values_by_slug.setdefault(value["interface"]["slug"], value)
+    return values_by_slug
 
-    raise RuntimeError(f"Image with interface {slug} not found!")
 
+def get_image_name(*, values_by_slug, slug):
+    # This tells us the user-provided name of the input or output image
+    if slug not in values_by_slug:
+        raise RuntimeError(f"Image with interface {slug} not found!")
+
+    return values_by_slug[slug]["image"]["name"]
 
-def get_interface_relative_path(*, values, slug):
+
+def get_interface_relative_path(*, values_by_slug, slug):
     # Gets the location of the interface relative to the input or output
-    for value in values:
-        if value["interface"]["slug"] == slug:
-            return value["interface"]["relative_path"]
+    if slug not in values_by_slug:
+        raise RuntimeError(f"Value with interface {slug} not found!")
 
-    raise RuntimeError(f"Value with interface {slug} not found!")
+    return values_by_slug[slug]["interface"]["relative_path"]
 
 
-def get_file_location(*, job_pk, values, slug):
+def get_file_location(*, job_pk, values_by_slug, slug):
     # Where a job's output file will be located in the evaluation container
-    relative_path = get_interface_relative_path(values=values, slug=slug)
+    relative_path = get_interface_relative_path(values_by_slug=values_by_slug, slug=slug)
     return INPUT_DIRECTORY / job_pk / "output" / relative_path
 
 
-def load_json_file(*, location):
-    # Reads a json file
-    with open(location) as f:
-        return json.loads(f.read())
+def _load_likelihood(path: Path) -> float:
+    # The likelihood file holds a bare JSON number, which float() parses directly,
+    # anything else (e.g. NaN) goes through the stdlib json parser as before
+    text = path.read_bytes().strip()
+    if _JSON_NUMBER.fullmatch(text):
+        return float(text)
+
+    return float(json.loads(text))
+
+
+def _find_one(directory: Path, suffixes=(".tiff", ".mha")) -> Path:
+    # Returns a file with the earliest listed suffix, using a single directory scan
+    matches = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.startswith(".") or not entry.is_file():
+                continue
+            for suffix in suffixes:
+                if entry.name.endswith(suffix):
+                    matches.setdefault(suffix, entry.path)
+                    break
+
+    for suffix in suffixes:
+        if suffix in matches:
+            return Path(matches[suffix])
+
+    raise RuntimeError(f"No {'/'.join(suffixes)} file found in {directory}!")
 
 
 def load_image_file(*, location):
     # Use SimpleITK to read a file
-    input_files = glob(str(location / "*.tiff")) + glob(str(location / "*.mha"))
-    result = SimpleITK.ReadImage(input_files[0])
+    result = SimpleITK.ReadImage(str(_find_one(location)))
 
     # Convert it to a Numpy array
     return SimpleITK.GetArrayFromImage(result)
 
 
+def _all_finite(obj):
+    # Checks that no float in a nested metrics document is NaN or infinite
+    if isinstance(obj, dict):
+        return all(_all_finite(value) for value in obj.values())
+    if isinstance(obj, (list, tuple)):
+        return all(_all_finite(value) for value in obj)
+    if isinstance(obj, (float, np.floating)):
+        return bool(np.isfinite(obj))
+    return True
+
+
 def write_metrics(*, metrics):
     # Write a json document used for ranking results on the leaderboard
-    with open(OUTPUT_DIRECTORY / "metrics.json", "w") as f:
-        f.write(json.dumps(metrics, indent=4))
+    if _all_finite(metrics):
+        data = orjson.dumps(
+            metrics, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY
+        )
+    else:
+        # orjson would write NaN/Infinity as null, keep them as the stdlib json does
+        data = json.dumps(metrics, indent=2).encode()
+    # Write in one go to a temporary file so metrics.json only ever appears complete
+    tmp = OUTPUT_DIRECTORY / "metrics.json.tmp"
+    try:
+        tmp.write_bytes(data)
+        os.replace(tmp, OUTPUT_DIRECTORY / "metrics.json")
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
 
 
 if __name__ == "__main__":